@@ -1,11 +1,65 @@
-import requests
+import asyncio
+import functools
+import hashlib
+import os
+import tempfile
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-import json
-import time
 from datetime import datetime, timedelta
 
+try:
+    import orjson as json  # 原生解析，接口返回体较大时明显更快
+except ImportError:
+    import json
+
+# ================== HTTP会话 ==================
+HTTP_HEADERS = {'Accept-Encoding': 'gzip, deflate'}
+HTTP_POOL_SIZE = 32
+
+def create_session():
+    """创建共享连接池的HTTP会话（keep-alive复用TCP/TLS连接）"""
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    return aiohttp.ClientSession(connector=connector, headers=HTTP_HEADERS)
+
+# ================== 本地缓存 ==================
+CACHE_DIR = '.cache'
+
+def parquet_cache(cache_dir=CACHE_DIR):
+    """按参数将异步数据获取结果缓存为Parquet文件（首个参数为HTTP会话，不参与缓存键）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(session, *args):
+            # 日期参数只取到天，保证同一天内重复运行能命中缓存
+            key = '|'.join(
+                a.strftime('%Y%m%d') if isinstance(a, datetime) else str(a) for a in args
+            )
+            digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+            path = os.path.join(cache_dir, f"{func.__name__}_{digest}.parquet")
+            
+            if os.path.exists(path):
+                return pd.read_parquet(path, engine='pyarrow')
+            
+            df = await func(session, *args)
+            if not df.empty:  # 获取失败的空结果不缓存
+                os.makedirs(cache_dir, exist_ok=True)
+                # 先写临时文件再原子替换，避免其他进程读到未写完的缓存
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                os.close(fd)
+                try:
+                    df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            return df
+        return wrapper
+    return decorator
+
 # ================== 基础数据获取 ==================
-def get_sohu_stock_data(code, start_date, end_date):
+@parquet_cache()
+async def get_sohu_stock_data(session, code, start_date, end_date):
     """通过搜狐财经API获取股票历史数据"""
     url = "http://q.stock.sohu.com/hisHq"
     params = {
@@ -18,97 +72,127 @@ def get_sohu_stock_data(code, start_date, end_date):
     }
     
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()[0]['hq']
+        async with session.get(url, params=params,
+                               timeout=aiohttp.ClientTimeout(total=10)) as response:
+            response.raise_for_status()
+            data = json.loads(await response.text())[0]['hq']  # 搜狐返回可能非UTF-8，按响应编码解码
         
         df = pd.DataFrame(data, columns=[
             'date', 'open', 'close_price', 'change', 'pct_change',
             'low', 'high', 'volume', 'amount', 'turnover_rate'
         ])
         df['date'] = pd.to_datetime(df['date'])
+        df['close_price'] = pd.to_numeric(df['close_price']).astype(np.float64)  # 接口返回字符串
         return df[['date', 'close_price']]
     
     except Exception as e:
         print(f"股票数据获取失败: {str(e)}")
         return pd.DataFrame()
 
-# ================== PE数据获取（基于网页4爬虫方案优化） ==================
-def get_hs300_pe_history(start_date, end_date):
-    """获取沪深300历史PE数据（基于东方财富API）"""
-    pe_data = []
-    current_date = start_date
+# ================== PE数据获取（东方财富K线接口，一次取回全部历史） ==================
+PE_URL = "https://push2his.eastmoney.com/api/qt/stock/kline/get"
+
+def _empty_pe_frame():
+    """空PE表，保持与正常结果一致的列类型以便合并"""
+    return pd.DataFrame({
+        'date': pd.Series(dtype='datetime64[ns]'),
+        'pe': pd.Series(dtype='float64')
+    })
+
+@parquet_cache()
+async def get_hs300_pe_history(session, start_date, end_date):
+    """获取沪深300历史PE数据（基于东方财富API，单次请求返回整段序列）"""
+    params = {
+        'secid': '1.000300',  # 沪深300
+        'klt': '101',         # 日K
+        'fqt': '1',
+        'beg': start_date.strftime("%Y%m%d"),
+        'end': end_date.strftime("%Y%m%d"),
+        'fields1': 'f1',
+        'fields2': 'f51,f9'   # 日期, PE
+    }
     
-    while current_date <= end_date:
-        url = "http://48.push2.eastmoney.com/api/qt/clist/get"
-        params = (
-            ('pn', '1'),
-            ('pz', '1'),
-            ('po', '1'),
-            ('np', '2'),
-            ('ut', 'bd1d9ddb04089700cf9c27f6f7426281'),
-            ('fltt', '2'),
-            ('invt', '2'),
-            ('fid', 'f3'),
-            ('fs', 'm:0+t:5'),  # 沪深300参数
-            ('fields', 'f1,f2,f3,f9,f12,f14,f20'),
-            ('tradeDate', current_date.strftime("%Y%m%d"))  # 关键日期参数
-        )
+    try:
+        async with session.get(PE_URL, params=params,
+                               timeout=aiohttp.ClientTimeout(total=10)) as response:
+            response.raise_for_status()
+            data = json.loads(await response.read())
         
-        try:
-            response = requests.get(url, params=params, timeout=10)
-            data = json.loads(response.text)
-            
-            if data['data']['diff']:
-                pe = data['data']['diff'][0]['f9']  # PE字段
-                pe_data.append({
-                    'date': current_date.strftime('%Y-%m-%d'),
-                    'pe': float(pe) if pe else None
-                })
-            time.sleep(0.5)  # 防止请求过快
-        except Exception as e:
-            print(f"{current_date} PE获取失败: {str(e)}")
+        klines = data['data']['klines'] if data.get('data') else []
+        if not klines:
+            return _empty_pe_frame()
         
-        current_date += timedelta(days=1)
+        df = pd.DataFrame([row.split(',') for row in klines], columns=['date', 'pe'])
+        df['date'] = pd.to_datetime(df['date'])
+        df['pe'] = pd.to_numeric(df['pe'], errors='coerce')
+        # 剔除周末数据
+        return df[df['date'].dt.weekday < 5].reset_index(drop=True)
     
-    return pd.DataFrame(pe_data)
+    except Exception as e:
+        print(f"PE数据获取失败: {str(e)}")
+        return _empty_pe_frame()
 
 # ================== 技术指标计算 ==================
 def calculate_ma250(df):
     """计算250日均线"""
-    if len(df) >= 250:
-        df['ma250'] = df['close_price'].astype(float).rolling(250).mean()
+    window = 250
+    if len(df) >= window:
+        # 前缀和求滑动均值：O(n)一次完成
+        arr = df['close_price'].to_numpy()
+        cum = np.concatenate(([0.0], arr.cumsum()))
+        ma = (cum[window:] - cum[:-window]) / window
+        df['ma250'] = np.concatenate((np.full(window - 1, np.nan), ma))
     else:
         print("数据不足250天，无法计算MA250")
         df['ma250'] = None
     return df
 
 # ================== 主程序 ==================
-def main(stock_code, years=3):
+BOND_CODE = "000012"  # 国债ETF
+GOLD_CODE = "518880"  # 黄金ETF
+
+async def fetch_shared(start_date, end_date):
+    """获取各股票共用的国债ETF、黄金ETF及沪深300PE数据（结果写入本地缓存）"""
+    async with create_session() as session:
+        return await asyncio.gather(
+            get_sohu_stock_data(session, BOND_CODE, start_date, end_date),
+            get_sohu_stock_data(session, GOLD_CODE, start_date, end_date),
+            get_hs300_pe_history(session, start_date, end_date)
+        )
+
+async def fetch_all(stock_code, start_date, end_date):
+    """并发获取目标股票、国债ETF、黄金ETF及沪深300PE数据"""
+    async with create_session() as session:
+        return await asyncio.gather(
+            get_sohu_stock_data(session, stock_code, start_date, end_date),  # 目标股票
+            get_sohu_stock_data(session, BOND_CODE, start_date, end_date),   # 国债ETF
+            get_sohu_stock_data(session, GOLD_CODE, start_date, end_date),   # 黄金ETF
+            get_hs300_pe_history(session, start_date, end_date)               # 沪深300PE
+        )
+
+def main(stock_code, years=3, excel=False):
     end_date = datetime.now()
     start_date = end_date - timedelta(days=365*years)
     
-    # 获取目标股票数据
-    main_df = get_sohu_stock_data(stock_code, start_date, end_date)
+    main_df, bond_df, gold_df, pe_df = asyncio.run(
+        fetch_all(stock_code, start_date, end_date)
+    )
     if main_df.empty:
         return
     
-    # 获取沪深300PE数据（网页4方法）
-    pe_df = get_hs300_pe_history(start_date, end_date)
-    
-    # 获取国债ETF数据
-    bond_df = get_sohu_stock_data("000012", start_date, end_date)
     bond_df.rename(columns={'close_price':'bond_price'}, inplace=True)
-    
-    # 获取黄金ETF数据 
-    gold_df = get_sohu_stock_data("518880", start_date, end_date)
     gold_df.rename(columns={'close_price':'gold_price'}, inplace=True)
     
-    # 数据合并
-    merged_df = pd.merge(main_df, pe_df, on='date', how='left')
+    # 数据合并（以日期为索引一次性左连接；日期重复说明源数据有误，直接报错）
+    main_df, pe_df, bond_df, gold_df = (
+        df.set_index('date') for df in (main_df, pe_df, bond_df, gold_df)
+    )
+    merged_df = main_df.join([
+        pe_df[['pe']],
+        bond_df[['bond_price']],
+        gold_df[['gold_price']]
+    ], how='left', validate='one_to_one').reset_index()
     merged_df = calculate_ma250(merged_df)
-    merged_df = pd.merge(merged_df, bond_df, on='date', how='left')
-    merged_df = pd.merge(merged_df, gold_df, on='date', how='left')
     
     # 补充字段（需其他数据源）
     merged_df['vix_index'] = None  # 波动率指数需专业接口
@@ -118,11 +202,28 @@ def main(stock_code, years=3):
         'date', 'pe', 'close_price', 'ma250',
         'bond_price', 'vix_index', 'gold_price'
     ]]
-    final_df['date'] = final_df['date'].dt.strftime('%Y-%m-%d')
     
-    # 保存Excel
-    final_df.to_excel(f"{stock_code}_history_data.xlsx", index=False)
-    print(f"文件已保存为 {stock_code}_history_data.xlsx")
+    # 保存Parquet
+    final_df.to_parquet(f"{stock_code}_history_data.parquet",
+                        engine='pyarrow', compression='zstd', index=False)
+    print(f"文件已保存为 {stock_code}_history_data.parquet")
+    
+    # 可选导出Excel（日期保持datetime类型，由写入器统一设置显示格式）
+    if excel:
+        with pd.ExcelWriter(f"{stock_code}_history_data.xlsx", engine='xlsxwriter',
+                            date_format='yyyy-mm-dd', datetime_format='yyyy-mm-dd') as writer:
+            final_df.to_excel(writer, index=False)
+        print(f"文件已保存为 {stock_code}_history_data.xlsx")
+
+def batch(codes, years=3, excel=False):
+    """多只股票并行执行main（每只股票一个进程）"""
+    # 共用数据先在主进程获取一次并写入缓存，各子进程直接读缓存
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=365*years)
+    asyncio.run(fetch_shared(start_date, end_date))
+    
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(functools.partial(main, years=years, excel=excel), codes))
 
 if __name__ == "__main__":
     main("600519")  # 示例：贵州茅台
\ No newline at end of file
@@ -1,108 +1,198 @@
 import pandas as pd
 import numpy as np
-from scipy import stats
+from numba import njit
+
+# 操作类型编码（记录时只存编码和数值，输出时再渲染为文字）
+BUY, MA_TP, PE_CUT, MACD_CUT, REBAL = range(5)
+ACTION_TEMPLATES = {
+    BUY: '买入 {:.0f} 元',
+    MA_TP: '均线偏离止盈 {:.0f}%',
+    PE_CUT: 'PE清仓50%',
+    MACD_CUT: 'MACD清仓30%',
+    REBAL: '调仓至股票 {:.1f}%',
+}
+
+@njit(cache=True)
+def pe_percentile(arr, lo, hi, cur):
+    """计算cur在arr中[lo, hi]区间内数据的分位值（与scipy percentileofscore kind='rank'一致）"""
+    # 无分支计数：区间掩码与比较结果按位与后求和
+    mask = (arr >= lo) & (arr <= hi)
+    n_total = mask.sum()
+    if n_total < 2:
+        return 50.0  # 默认中位数
+    if np.isnan(cur):
+        return np.nan  # 当日PE缺失时分位未知，与scipy percentileofscore一致
+    n_below = ((arr < cur) & mask).sum()
+    n_equal = ((arr == cur) & mask).sum()
+    # 并列值取平均名次
+    return (2 * n_below + n_equal + (n_equal > 0)) * 50.0 / n_total
+
+@njit(cache=True)
+def rolling_pe_percentile(arr, window, lo, hi):
+    """逐行计算近window条数据中当日PE的分位（直接遍历原数组，保留float32精度）"""
+    out = np.empty(len(arr), dtype=np.float64)
+    for i in range(len(arr)):
+        w = arr[max(0, i - window + 1):i + 1]
+        if np.isnan(w).all():
+            out[i] = np.nan  # 窗口内无有效数据，与rolling(min_periods=1)一致
+        else:
+            out[i] = pe_percentile(w, lo, hi, w[-1])
+    return out
+
+@njit(cache=True)
+def _invest(pe_pct, base_invest, low_band, high_band, consecutive_low, reserve, cash, stock_shares, close_price):
+    """定投数值核心，返回(投入金额, 是否买入, 连续低估计数, 储备金, 现金, 股票份额)"""
+    invest_amount = 0.0
+    if pe_pct < low_band:
+        invest_amount = base_invest * 2.0
+        consecutive_low += 1
+    elif low_band <= pe_pct <= high_band:
+        invest_amount = base_invest
+        consecutive_low = 0
+    else:
+        consecutive_low = 0
+    
+    # 应急加仓检查
+    if consecutive_low >= 3:
+        emergency_amount = reserve * 0.5
+        invest_amount += emergency_amount
+        reserve -= emergency_amount
+        consecutive_low = 0  # 重置计数器
+    
+    # 执行买入
+    bought = invest_amount > 0 and cash >= invest_amount
+    if bought:
+        stock_shares += invest_amount / close_price
+        cash -= invest_amount
+    return invest_amount, bought, consecutive_low, reserve, cash, stock_shares
+
+@njit(cache=True)
+def _rebalance(cash, stock_shares, bond_shares, pe_pct, stock_price, bond_price):
+    """股债再平衡数值核心，返回(现金, 股票份额, 债券份额, 股票目标比例)"""
+    # 计算目标比例
+    stock_ratio = 1 - max(0.3, pe_pct / 100)
+    total_assets = cash + stock_shares*stock_price + bond_shares*bond_price
+    
+    # 计算目标市值
+    target_stock = total_assets * stock_ratio
+    target_bond = total_assets * (1 - stock_ratio)
+    
+    # 调整持仓（假设可以部分交易）
+    delta_stock = (target_stock - stock_shares*stock_price) / stock_price
+    delta_bond = (target_bond - bond_shares*bond_price) / bond_price
+    stock_shares += delta_stock
+    bond_shares += delta_bond
+    cash -= (delta_stock*stock_price + delta_bond*bond_price)
+    return cash, stock_shares, bond_shares, stock_ratio
 
 class InvestmentSimulator:
-    def __init__(self, initial_capital=100000, base_invest=3000):
+    def __init__(self, initial_capital=100000, base_invest=3000, max_ops=1024):
         # 初始化账户状态
         self.cash = initial_capital
         self.stock_shares = 0.0
         self.bond_shares = 0.0
         self.reserve = 6 * base_invest  # 应急储备金
         self.base_invest = base_invest
-        self.operations_log = []
+        
+        # 操作记录（按列预分配，_log_n为已写入条数）
+        self._log_n = 0
+        self._log_date = np.empty(max_ops, dtype='datetime64[D]')
+        self._log_code = np.empty(max_ops, dtype=np.int8)
+        self._log_amt = np.empty(max_ops, dtype=np.float64)
+        self._log_pe_pct = np.full(max_ops, np.nan)
         
         # 策略参数
         self.PE_BANDS = [30, 60]  # 低估/高估分界线
         self.EMERGENCY_THRESHOLD = 15  # 应急加仓阈值
         self.consecutive_low = 0  # 连续低估计数
+        self.pe_percentile = 50.0  # 最近一次定投时的PE分位
+        
+        # 市场数据存储（完整PE序列 + 当前已推进到的位置）
+        self.hist_pe_array = np.empty(0, dtype=np.float64)
+        self.hist_len = 0
         
-        # 市场数据存储
-        self.hist_pe = pd.DataFrame(columns=['date', 'pe', 'close', 'ma250'])
+    def load_market_data(self, pe_arr):
+        """载入完整PE序列（回测前一次性调用）"""
+        self.hist_pe_array = np.asarray(pe_arr)  # 保留传入精度（可为float32）
+        self.hist_len = 0
         
-    def update_market_data(self, new_data):
-        """更新市场数据"""
-        self.hist_pe = pd.concat([self.hist_pe, new_data], ignore_index=True)
+    def update_market_data(self, idx):
+        """推进到第idx个交易日（含当日）"""
+        self.hist_len = idx + 1
+        
+    def log_operation(self, current_date, code, amount=np.nan, pe_percentile=np.nan):
+        """记录一次操作，预分配空间用尽时扩容一倍"""
+        if self._log_n == len(self._log_date):
+            size = max(1, 2 * self._log_n)
+            self._log_date = np.resize(self._log_date, size)
+            self._log_code = np.resize(self._log_code, size)
+            self._log_amt = np.resize(self._log_amt, size)
+            self._log_pe_pct = np.resize(self._log_pe_pct, size)
+        n = self._log_n
+        self._log_date[n] = current_date
+        self._log_code[n] = code
+        self._log_amt[n] = amount
+        self._log_pe_pct[n] = pe_percentile
+        self._log_n += 1
+        
+    @property
+    def operations_log(self):
+        """操作记录表"""
+        n = self._log_n
+        actions = [
+            ACTION_TEMPLATES[code].format(amount)
+            for code, amount in zip(self._log_code[:n].tolist(), self._log_amt[:n].tolist())
+        ]
+        return pd.DataFrame({
+            'date': self._log_date[:n],
+            'action': actions,
+            'PE分位': self._log_pe_pct[:n]
+        })
         
     def calculate_pe_percentile(self, current_pe):
         """计算PE历史分位值（剔除极端值）"""
         # 获取过去10年数据（120个月）
         lookback = 120
-        if len(self.hist_pe) < lookback:
-            usable_data = self.hist_pe['pe']
-        else:
-            usable_data = self.hist_pe['pe'].iloc[-lookback:]
+        start = max(0, self.hist_len - lookback)
+        usable_data = self.hist_pe_array[start:self.hist_len]
         
-        # 剔除极端值
-        filtered = usable_data[(usable_data >= 8) & (usable_data <= 20)]
-        if len(filtered) < 2:
-            return 50  # 默认中位数
-            
-        # 计算分位
-        return stats.percentileofscore(filtered, current_pe)
+        # 剔除极端值(8~20以外)后计算分位
+        return pe_percentile(usable_data, 8.0, 20.0, current_pe)
         
-    def execute_investment(self, current_date, pe, close_price):
-        """执行每月定投操作"""
+    def execute_investment(self, current_date, pe, close_price, pe_percentile=None):
+        """执行每月定投操作（pe_percentile可传入预先计算好的分位值）"""
         # 计算PE分位
-        pe_percentile = self.calculate_pe_percentile(pe)
+        if pe_percentile is None:
+            pe_percentile = self.calculate_pe_percentile(pe)
+        
+        self.pe_percentile = pe_percentile  # 供止盈检查使用
         
         # 定投逻辑
-        invest_amount = 0
-        if pe_percentile < self.PE_BANDS[0]:
-            invest_amount = self.base_invest * 2
-            self.consecutive_low += 1
-        elif self.PE_BANDS[0] <= pe_percentile <= self.PE_BANDS[1]:
-            invest_amount = self.base_invest
-            self.consecutive_low = 0
-        else:
-            self.consecutive_low = 0
-            
-        # 应急加仓检查
-        if self.consecutive_low >= 3:
-            emergency_amount = self.reserve * 0.5
-            invest_amount += emergency_amount
-            self.reserve -= emergency_amount
-            self.consecutive_low = 0  # 重置计数器
-            
-        # 执行买入
-        if invest_amount > 0 and self.cash >= invest_amount:
-            self.stock_shares += invest_amount / close_price
-            self.cash -= invest_amount
-            self.operations_log.append({
-                'date': current_date,
-                'action': f'买入 {invest_amount:.0f} 元',
-                'PE分位': pe_percentile
-            })
+        (invest_amount, bought, self.consecutive_low, self.reserve,
+         self.cash, self.stock_shares) = _invest(
+            float(pe_percentile), float(self.base_invest),
+            float(self.PE_BANDS[0]), float(self.PE_BANDS[1]),
+            self.consecutive_low, float(self.reserve),
+            float(self.cash), float(self.stock_shares), float(close_price)
+        )
+        if bought:
+            self.log_operation(current_date, BUY, invest_amount, pe_percentile)
             
         return pe_percentile
         
-    def rebalance_portfolio(self, pe_percentile, stock_price, bond_price):
+    def rebalance_portfolio(self, current_date, pe_percentile, stock_price, bond_price):
         """执行股债再平衡"""
-        # 计算目标比例
-        stock_ratio = 1 - max(0.3, pe_percentile/100)
-        total_assets = self.cash + self.stock_shares*stock_price + self.bond_shares*bond_price
-        
-        # 计算目标市值
-        target_stock = total_assets * stock_ratio
-        target_bond = total_assets * (1 - stock_ratio)
-        
-        # 调整持仓
-        delta_stock = (target_stock - self.stock_shares*stock_price) / stock_price
-        delta_bond = (target_bond - self.bond_shares*bond_price) / bond_price
-        
-        # 执行交易（假设可以部分交易）
-        self.stock_shares += delta_stock
-        self.bond_shares += delta_bond
-        self.cash -= (delta_stock*stock_price + delta_bond*bond_price)
-        
-        self.operations_log.append({
-            'date': current_date,
-            'action': f'调仓至股票 {stock_ratio*100:.1f}%',
-            'PE分位': pe_percentile
-        })
+        self.cash, self.stock_shares, self.bond_shares, stock_ratio = _rebalance(
+            float(self.cash), float(self.stock_shares), float(self.bond_shares),
+            float(pe_percentile), float(stock_price), float(bond_price)
+        )
+        
+        self.log_operation(current_date, REBAL, stock_ratio*100, pe_percentile)
     
-    def check_profit_conditions(self, current_price, ma250, macd_signal):
+    def check_profit_conditions(self, current_date, current_price, ma250, macd_signal):
         """复合止盈检查"""
+        current_price, ma250 = float(current_price), float(ma250)  # 资金核算统一用float64
+        
         # 均线偏离检查
         price_deviation = (current_price - ma250) / ma250
         if price_deviation > 0.2:
@@ -111,52 +201,66 @@ class InvestmentSimulator:
                 shares_to_sell = self.stock_shares * sell_percent
                 self.cash += shares_to_sell * current_price
                 self.stock_shares -= shares_to_sell
-                self.operations_log.append({
-                    'date': current_date,
-                    'action': f'均线偏离止盈 {sell_percent*100:.0f}%'
-                })
+                self.log_operation(current_date, MA_TP, sell_percent*100)
                 
         # 强制清仓检查
         if self.pe_percentile >= 90:
             self.cash += self.stock_shares * 0.5 * current_price
             self.stock_shares *= 0.5
-            self.operations_log.append({'date': current_date, 'action': 'PE清仓50%'})
+            self.log_operation(current_date, PE_CUT)
             
         if macd_signal == 'bearish':
             self.cash += self.stock_shares * 0.3 * current_price
             self.stock_shares *= 0.7
-            self.operations_log.append({'date': current_date, 'action': 'MACD清仓30%'})
+            self.log_operation(current_date, MACD_CUT)
 
 # 使用示例（需配合历史数据加载）：
 if __name__ == "__main__":
-    # 初始化模拟器
-    simulator = InvestmentSimulator(initial_capital=100000)
-    
     # 假设从CSV加载历史数据（示例结构）
     # date | pe | close_price | ma250 | bond_price | macd_signal
     historical_data = pd.read_csv('historical_data.csv')
     
-    for idx, row in historical_data.iterrows():
-        simulator.update_market_data(pd.DataFrame([row]))
+    # 行情序列降为float32，减半内存带宽（资金核算仍为float64）
+    for col in ['pe', 'close_price', 'ma250', 'bond_price']:
+        historical_data[col] = pd.to_numeric(historical_data[col], downcast='float')
+    
+    # 预先计算每日PE分位（近120条数据滚动窗口，与calculate_pe_percentile口径一致）
+    historical_data['pe_pct'] = rolling_pe_percentile(
+        historical_data['pe'].to_numpy(), 120, 8.0, 20.0
+    )
+    
+    # 一次性取出各列为numpy数组，循环内按整数位置访问
+    dates = historical_data['date'].to_numpy()
+    pe_arr = historical_data['pe'].to_numpy()
+    close_arr = historical_data['close_price'].to_numpy()
+    ma250_arr = historical_data['ma250'].to_numpy()
+    bond_arr = historical_data['bond_price'].to_numpy()
+    macd_arr = historical_data['macd_signal'].to_numpy()
+    pe_pct_arr = historical_data['pe_pct'].to_numpy()
+    invest_days = np.flatnonzero(historical_data['date'].str.endswith('-20').to_numpy())  # 每月20日执行
+    
+    # 初始化模拟器（每个定投日最多5条操作记录）
+    simulator = InvestmentSimulator(initial_capital=100000, max_ops=5 * len(invest_days))
+    simulator.load_market_data(pe_arr)  # 完整历史已知，PE分位已预先算好，循环内无需逐日推进
+    
+    for i in invest_days:
+        pe_percent = simulator.execute_investment(
+            dates[i], pe_arr[i], close_arr[i], pe_pct_arr[i]
+        )
         
-        if row['date'].endswith('-20'):  # 每月20日执行
-            pe_percent = simulator.execute_investment(
-                row['date'], row['pe'], row['close_price']
-            )
-            
-            simulator.rebalance_portfolio(
-                pe_percent, row['close_price'], row['bond_price']
-            )
-            
-            simulator.check_profit_conditions(
-                row['close_price'], row['ma250'], row['macd_signal']
-            )
+        simulator.rebalance_portfolio(
+            dates[i], pe_percent, close_arr[i], bond_arr[i]
+        )
+        
+        simulator.check_profit_conditions(
+            dates[i], close_arr[i], ma250_arr[i], macd_arr[i]
+        )
     
     # 输出最终结果
     print("操作记录：")
-    print(pd.DataFrame(simulator.operations_log))
+    print(simulator.operations_log)
     
     final_value = simulator.cash + \
-        simulator.stock_shares * historical_data['close_price'].iloc[-1] + \
-        simulator.bond_shares * historical_data['bond_price'].iloc[-1]
+        simulator.stock_shares * float(close_arr[-1]) + \
+        simulator.bond_shares * float(bond_arr[-1])
     print(f"\n最终资产总值：{final_value:.2f}元")
\ No newline at end of file